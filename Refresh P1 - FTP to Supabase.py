@@ -1,15 +1,23 @@
-# First install the required packages
-!pip install python-supabase python-dotenv ftplib
+# First install the required packages, skipping any that are already present
+import importlib.util
+import subprocess
+import sys
+
+for module, package in [('supabase', 'supabase'), ('dotenv', 'python-dotenv'), ('pandas', 'pandas'), ('h2', 'httpx[http2]')]:
+    if importlib.util.find_spec(module) is None:
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet', package])
 
 import os
-import csv
 import io
-import tempfile
-from supabase import create_client, Client
+import time
+import uuid
+import pandas as pd
+import httpx
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 from datetime import datetime
 import logging
-import ftplib
+from ftp_utils import connect_to_ftp, get_csv_files_from_ftp, download_csvs, close_ftp
 
 # Load environment variables
 load_dotenv()
@@ -37,209 +45,237 @@ def setup_supabase():
 
     # Initialize Supabase client
     logger.info("Setting up Supabase connection")
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    return supabase
 
-# Function to connect to FTP server using environment variables
-def connect_to_ftp():
-    """Connect to FTP server using environment variables"""
-    # Get FTP credentials from environment variables
-    FTP_HOST = os.getenv("FTP_HOST")
-    FTP_USER = os.getenv("FTP_USER")
-    FTP_PASS = os.getenv("FTP_PASS")
-    FTP_PATH = os.getenv("FTP_PATH", "/")  # Default to root if not specified
+    # Share one pooled HTTP/2 client with keep-alive connections across requests;
+    # reads keep supabase-py's 120 s default, since large SQL calls can run long
+    http_client = httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=20),
+        timeout=httpx.Timeout(30, read=120)
+    )
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
+    return supabase
 
-    if not all([FTP_HOST, FTP_USER, FTP_PASS]):
-        raise ValueError("Missing FTP credentials. Please set FTP_HOST, FTP_USER, and FTP_PASS environment variables.")
+# Function to parse a downloaded CSV file in chunks
+def iter_csv(buffer, filename, chunksize=10_000):
+    """Parse a downloaded CSV file into DataFrame chunks"""
+    total_rows = 0
 
     try:
-        # Connect to FTP server
-        logger.info(f"Connecting to FTP server: {FTP_HOST}")
-        ftp = ftplib.FTP(FTP_HOST)
-        ftp.login(FTP_USER, FTP_PASS)
+        # Read the CSV file, keeping only the columns needed for the comparison
+        reader = pd.read_csv(
+            buffer,
+            usecols=['isbn', 'stock', 'rrp'],
+            dtype={'isbn': 'string'},
+            encoding='utf-8-sig',
+            chunksize=chunksize
+        )
+
+        for chunk in reader:
+            # Convert stock and RRP in bulk; invalid values become missing
+            stock = pd.to_numeric(chunk['stock'], errors='coerce')
+            chunk['stock'] = stock.where(stock % 1 == 0).astype('Int64')
+            chunk['rrp'] = pd.to_numeric(chunk['rrp'], errors='coerce')
+
+            total_rows += len(chunk)
+            yield chunk
+
+        logger.info(f"Successfully parsed {filename} with {total_rows} rows")
 
-        # Change to specified directory if provided
-        if FTP_PATH != "/":
-            ftp.cwd(FTP_PATH)
-            logger.info(f"Changed to directory: {FTP_PATH}")
-
-        return ftp
     except Exception as e:
-        logger.error(f"Failed to connect to FTP server: {str(e)}")
-        raise
+        logger.error(f"Error parsing {filename}: {str(e)}")
+
+# Define the inventory table name in Supabase
+INVENTORY_TABLE = "inventory"
+STAGING_TABLE = "staging_inventory"
+TEMP_MODIFIED_TABLE = f"modified_inventory_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
-# Function to get all CSV files from FTP server
-def get_csv_files_from_ftp(ftp):
-    """Get all CSV files from FTP server"""
-    # Get all file names in the current directory
-    file_list = []
+# Identifies this run's rows in the shared staging table
+RUN_ID = uuid.uuid4().hex
 
-    try:
-        # List all files in the current directory
-        ftp.retrlines('LIST', lambda x: file_list.append(x.split()[-1]))
+def create_temp_table(supabase: Client):
+    """Create a temporary table to store modified records"""
+    logger.info(f"Creating temporary table: {TEMP_MODIFIED_TABLE}")
 
-        # Filter for .text or .csv files
-        csv_files = [f for f in file_list if f.endswith('.text') or f.endswith('.csv')]
+    # SQL query to create the table, keyed by ISBN and with the columns P2 fills in
+    query = f"""
+    CREATE TABLE {TEMP_MODIFIED_TABLE} (
+        isbn text PRIMARY KEY,
+        old_stock integer,
+        new_stock integer,
+        old_rrp numeric,
+        new_rrp numeric,
+        modified_at timestamptz DEFAULT now(),
+        ebay_updated boolean,
+        ebay_update_time timestamptz,
+        ebay_update_details text
+    );
+    """
 
-        if not csv_files:
-            logger.warning("No CSV files found on FTP server")
-            return []
+    # Execute raw SQL query
+    supabase.table("dummy").select("*").limit(1).execute()  # Ensure connection is working
 
-        logger.info(f"Found {len(csv_files)} CSV files on FTP server")
-        return csv_files
+    # Using RPC call to execute raw SQL
+    supabase.rpc('exec_sql', {'sql': query}).execute()
 
-    except Exception as e:
-        logger.error(f"Error listing files on FTP server: {str(e)}")
-        return []
+    logger.info(f"Temporary table {TEMP_MODIFIED_TABLE} created successfully")
 
-# Function to download and parse a CSV file from FTP
-def download_and_parse_csv(ftp, filename):
-    """Download and parse a CSV file from FTP server"""
+def create_staging_table(supabase: Client):
+    """Make sure the shared staging table for CSV data exists, creating it on the first run"""
     try:
-        # Create a temporary file to store CSV content
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
-            # Download the file
-            logger.info(f"Downloading {filename} from FTP server")
-            ftp.retrbinary(f"RETR {filename}", temp_file.write)
-            temp_filename = temp_file.name
-
-        # Read the CSV file
-        with open(temp_filename, 'r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            rows = list(reader)
+        supabase.table(STAGING_TABLE).select("run_id").limit(1).execute()
+        return
+    except Exception:
+        logger.info(f"Creating staging table: {STAGING_TABLE}")
 
-        # Clean up temporary file
-        os.unlink(temp_filename)
+    # SQL query to create the staging table; rows are keyed by run, so runs started
+    # at the same time keep their rows apart
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {STAGING_TABLE} (
+        run_id text NOT NULL,
+        isbn text NOT NULL,
+        stock integer,
+        rrp numeric,
+        PRIMARY KEY (run_id, isbn)
+    );
+    NOTIFY pgrst, 'reload schema';
+    """
 
-        logger.info(f"Successfully parsed {filename} with {len(rows)} rows")
-        return rows
+    # Using RPC call to execute raw SQL
+    supabase.rpc('exec_sql', {'sql': query}).execute()
 
+    # The API reloads its schema in the background, so wait until it can see the new table
+    max_attempts = 5
+    for attempt in range(max_attempts):
+        time.sleep(2 ** attempt)
+        try:
+            supabase.table(STAGING_TABLE).select("run_id").limit(1).execute()
+            break
+        except Exception:
+            if attempt == max_attempts - 1:
+                raise
+
+    logger.info(f"Staging table {STAGING_TABLE} created successfully")
+
+def clear_staging_rows(supabase: Client):
+    """Delete this run's rows from the staging table once they have been synced"""
+    try:
+        supabase.rpc('exec_sql', {'sql': f"DELETE FROM {STAGING_TABLE} WHERE run_id = '{RUN_ID}';"}).execute()
+        logger.info(f"Cleared this run's rows from {STAGING_TABLE}")
     except Exception as e:
-        logger.error(f"Error downloading or parsing {filename}: {str(e)}")
-        return []
-
-# Define the inventory table name in Supabase
-INVENTORY_TABLE = "inventory"
-TEMP_MODIFIED_TABLE = f"modified_inventory_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        logger.error(f"Error clearing rows from {STAGING_TABLE}: {str(e)}")
 
-def create_temp_table(supabase: Client):
-    """Create a temporary table to store modified records"""
-    logger.info(f"Creating temporary table: {TEMP_MODIFIED_TABLE}")
+def sync_inventory(supabase: Client):
+    """Apply staged CSV values to the inventory and record the differences in the temporary table"""
+    logger.info(f"Comparing {STAGING_TABLE} with {INVENTORY_TABLE}")
 
-    # SQL query to create the table based on the existing inventory table
+    # SQL query to find changed rows, update the inventory and fill the temporary
+    # table in one statement, so the comparison runs where the data already is.
+    # Prices are compared to the penny, so sub-penny differences are not changes
     query = f"""
-    CREATE TABLE {TEMP_MODIFIED_TABLE} AS
-    SELECT isbn, stock as old_stock, stock as new_stock, rrp as old_rrp, rrp as new_rrp,
-           CURRENT_TIMESTAMP as modified_at
-    FROM {INVENTORY_TABLE}
-    WHERE 1=0;
+    WITH changes AS (
+        SELECT s.isbn, i.stock AS old_stock, s.stock AS new_stock, i.rrp AS old_rrp, s.rrp AS new_rrp
+        FROM {STAGING_TABLE} s
+        JOIN {INVENTORY_TABLE} i USING (isbn)
+        WHERE s.run_id = '{RUN_ID}'
+          AND (s.stock IS DISTINCT FROM i.stock OR round(s.rrp, 2) IS DISTINCT FROM round(i.rrp, 2))
+    ), updated AS (
+        UPDATE {INVENTORY_TABLE} i
+        SET stock = c.new_stock, rrp = c.new_rrp
+        FROM changes c
+        WHERE i.isbn = c.isbn
+    )
+    INSERT INTO {TEMP_MODIFIED_TABLE} (isbn, old_stock, new_stock, old_rrp, new_rrp, modified_at)
+    SELECT isbn, old_stock, new_stock, old_rrp, new_rrp, CURRENT_TIMESTAMP
+    FROM changes;
+
+    DELETE FROM {STAGING_TABLE} s
+    USING {INVENTORY_TABLE} i
+    WHERE s.run_id = '{RUN_ID}' AND s.isbn = i.isbn;
     """
 
-    # Execute raw SQL query
-    supabase.table("dummy").select("*").limit(1).execute()  # Ensure connection is working
-
     # Using RPC call to execute raw SQL
     supabase.rpc('exec_sql', {'sql': query}).execute()
 
-    logger.info(f"Temporary table {TEMP_MODIFIED_TABLE} created successfully")
+    # Only ISBNs that are not in the inventory are left among this run's staged rows
+    response = supabase.table(STAGING_TABLE).select("isbn", count="exact").eq("run_id", RUN_ID).limit(1).execute()
+    not_found_count = response.count or 0
 
-def get_inventory_from_supabase(supabase: Client):
-    """Retrieve current inventory data from Supabase"""
-    response = supabase.table(INVENTORY_TABLE).select("isbn, stock, rrp").execute()
+    if not_found_count:
+        logger.warning(f"Warning: {not_found_count} ISBNs not found in inventory")
 
-    # Convert to dictionary with ISBN as key for easier lookup
-    inventory_dict = {}
-    for item in response.data:
-        inventory_dict[item['isbn']] = {
-            'stock': item['stock'],
-            'rrp': item['rrp']
-        }
+    # Count the records written to the temporary table
+    response = supabase.table(TEMP_MODIFIED_TABLE).select("isbn", count="exact").limit(1).execute()
+    modified_count = response.count or 0
 
-    logger.info(f"Retrieved {len(inventory_dict)} inventory items from Supabase")
-    return inventory_dict
+    logger.info(f"Found {modified_count} records with differences")
+    return modified_count
 
 def process_csv_files(supabase: Client, ftp):
-    """Process all CSV files from FTP server and compare with Supabase inventory"""
+    """Upload all CSV files from FTP server to the staging table and sync them with Supabase inventory"""
     # Get all CSV files from FTP server
     csv_files = get_csv_files_from_ftp(ftp)
 
     if not csv_files:
         logger.warning("No CSV files found on FTP server. Exiting.")
-        return []
-
-    # Get current inventory from Supabase
-    supabase_inventory = get_inventory_from_supabase(supabase)
+        return 0
 
-    # Track modified records
-    modified_records = []
+    # Prepare the staging table
+    create_staging_table(supabase)
 
-    # Process each CSV file
-    for filename in csv_files:
+    try:
+        return stage_and_sync(supabase, ftp, csv_files)
+    finally:
+        clear_staging_rows(supabase)
+
+def stage_and_sync(supabase: Client, ftp, csv_files):
+    """Upload the CSV files to the staging table and sync them with Supabase inventory"""
+    # Upload rows in batches to avoid payload size limits
+    batch_size = 500
+    staged_rows = 0
+
+    # Download the CSV files while they are processed, so only a few are in memory at once
+    for filename, content in download_csvs(ftp, csv_files):
         logger.info(f"Processing {filename}...")
 
-        # Download and parse CSV file
-        rows = download_and_parse_csv(ftp, filename)
-
-        # Process each row
-        for row in rows:
-            isbn = row.get('isbn')
-
-            if not isbn:
-                logger.warning(f"Warning: Row missing ISBN in {filename}")
-                continue
-
-            # Get the current CSV values
-            try:
-                csv_stock = int(row.get('stock', 0))
-                csv_rrp = float(row.get('rrp', 0.0))
-            except (ValueError, TypeError):
-                logger.warning(f"Warning: Invalid stock or RRP value for ISBN {isbn}")
-                continue
-
-            # Check if this ISBN exists in Supabase
-            if isbn in supabase_inventory:
-                supabase_stock = supabase_inventory[isbn]['stock']
-                supabase_rrp = supabase_inventory[isbn]['rrp']
-
-                # Check for differences
-                if csv_stock != supabase_stock or csv_rrp != supabase_rrp:
-                    logger.info(f"Difference found for ISBN {isbn}:")
-                    logger.info(f"  Stock: {supabase_stock} → {csv_stock}")
-                    logger.info(f"  RRP: {supabase_rrp} → {csv_rrp}")
-
-                    # Update record in Supabase
-                    supabase.table(INVENTORY_TABLE) \
-                        .update({"stock": csv_stock, "rrp": csv_rrp}) \
-                        .eq("isbn", isbn) \
-                        .execute()
-
-                    # Store for the temporary table
-                    modified_records.append({
-                        "isbn": isbn,
-                        "old_stock": supabase_stock,
-                        "new_stock": csv_stock,
-                        "old_rrp": supabase_rrp,
-                        "new_rrp": csv_rrp,
-                        "modified_at": datetime.now().isoformat()
-                    })
-            else:
-                logger.info(f"ISBN {isbn} not found in Supabase inventory")
-
-    logger.info(f"Found {len(modified_records)} records with differences")
-    return modified_records
-
-def save_modified_records(supabase: Client, modified_records):
-    """Save modified records to the temporary table"""
-    if not modified_records:
-        logger.info("No records were modified")
-        return
+        missing_count = 0
+        invalid_count = 0
+
+        # Stream the file so only one chunk is held in memory at a time
+        for chunk in iter_csv(io.BytesIO(content), filename):
+            # Drop rows that cannot be compared
+            missing_isbn = chunk['isbn'].isna()
+            invalid = ~missing_isbn & (chunk['stock'].isna() | chunk['rrp'].isna())
+            missing_count += missing_isbn.sum()
+            invalid_count += invalid.sum()
 
-    logger.info(f"Saving {len(modified_records)} modified records to {TEMP_MODIFIED_TABLE}")
+            # A single upsert cannot touch the same ISBN twice; later rows and files take precedence
+            records = chunk[~missing_isbn & ~invalid] \
+                .drop_duplicates('isbn', keep='last') \
+                .assign(run_id=RUN_ID) \
+                .astype(object) \
+                .to_dict('records')
 
-    # Insert records into temporary table
-    supabase.table(TEMP_MODIFIED_TABLE).insert(modified_records).execute()
+            for i in range(0, len(records), batch_size):
+                batch = records[i:i+batch_size]
+                supabase.table(STAGING_TABLE).upsert(batch, on_conflict="run_id,isbn").execute()
 
-    logger.info("Modified records saved successfully")
+            staged_rows += len(records)
+
+        if missing_count:
+            logger.warning(f"Warning: {missing_count} rows missing ISBN in {filename}")
+        if invalid_count:
+            logger.warning(f"Warning: {invalid_count} rows with invalid stock or RRP values in {filename}")
+
+    if not staged_rows:
+        logger.warning("No CSV data could be parsed. Exiting.")
+        return 0
+
+    logger.info(f"Uploaded {staged_rows} rows to {STAGING_TABLE}")
+
+    # Compare and update inside the database
+    return sync_inventory(supabase)
 
 # For Google Colab: Create a .env file with credentials
 def setup_env_file():
@@ -276,7 +312,7 @@ def main():
 
     try:
         # For Colab, create an env file template if needed
-        if 'google.colab' in str(get_ipython()):
+        if 'google.colab' in sys.modules:
             setup_env_file()
 
         # Setup connections
@@ -286,16 +322,13 @@ def main():
         # Create temporary table for tracking modifications
         create_temp_table(supabase)
 
-        # Process CSV files and get modified records
-        modified_records = process_csv_files(supabase, ftp)
-
-        # Save modified records to temporary table
-        save_modified_records(supabase, modified_records)
+        # Process CSV files and record modified records in the temporary table
+        modified_count = process_csv_files(supabase, ftp)
 
-        # Close FTP connection
-        ftp.quit()
+        # Close FTP connection; the server may already have dropped it while idle
+        close_ftp(ftp)
 
-        logger.info(f"Inventory synchronization completed! Modified records: {len(modified_records)}")
+        logger.info(f"Inventory synchronization completed! Modified records: {modified_count}")
 
     except Exception as e:
         logger.error(f"Error during synchronization process: {str(e)}")
@@ -1,13 +1,20 @@
-# First install required packages
-!pip install supabase-py ebaysdk python-dotenv
+# First install required packages, skipping any that are already present
+import importlib.util
+import subprocess
+import sys
+
+for module, package in [('supabase', 'supabase'), ('ebaysdk', 'ebaysdk'), ('dotenv', 'python-dotenv'), ('h2', 'httpx[http2]')]:
+    if importlib.util.find_spec(module) is None:
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet', package])
 
 import os
 import json
 import time
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, ClientOptions
 from ebaysdk.trading import Connection as Trading
 from ebaysdk.exception import ConnectionError
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
 
@@ -37,7 +44,16 @@ def setup_supabase():
 
     # Initialize Supabase client
     logger.info("Setting up Supabase connection")
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    # Share one pooled HTTP/2 client with keep-alive connections across requests;
+    # reads keep supabase-py's 120 s default, since large SQL calls can run long
+    http_client = httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=20),
+        timeout=httpx.Timeout(30, read=120)
+    )
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
     return supabase
 
 # Function to set up eBay API connection using environment variables
@@ -65,63 +81,132 @@ def setup_ebay_api():
 
     return api
 
-# Function to get eBay item ID using ISBN
-def get_ebay_item_id(api, isbn):
+# Function to build an index of eBay item IDs by SKU
+def build_sku_index(api, rate_limiter):
     """
-    Get eBay item ID using ISBN as a search term
-    Returns None if the item is not found
+    Build a {SKU: item ID} index of the seller's active eBay listings
+    Pages through GetSellerList once instead of searching for every ISBN
+    Raises ConnectionError if a page still fails after retrying, since an
+    incomplete index would report listed items as not found
     """
-    try:
-        # Search for items with this ISBN
-        response = api.execute('GetSellerList', {
-            'DetailLevel': 'ReturnAll',
-            'SKUArray': {'SKU': isbn}
-        })
-
-        # Check if any items were found
+    sku_index = {}
+    page_number = 1
+    max_attempts = 3
+
+    # GetSellerList needs a time window of at most 120 days; active listings end within it
+    end_time_from = datetime.utcnow()
+    end_time_to = end_time_from + timedelta(days=120)
+
+    while True:
+        # Retry the page on temporary errors, waiting longer after each attempt
+        for attempt in range(1, max_attempts + 1):
+            try:
+                rate_limiter.wait()
+                response = api.execute('GetSellerList', {
+                    'DetailLevel': 'ReturnAll',
+                    'EndTimeFrom': end_time_from.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'EndTimeTo': end_time_to.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'Pagination': {'EntriesPerPage': 200, 'PageNumber': page_number},
+                    'OutputSelector': ['ItemArray.Item.ItemID', 'ItemArray.Item.SKU', 'HasMoreItems']
+                })
+                break
+
+            except ConnectionError as e:
+                logger.error(f"eBay API error while listing seller items on page {page_number} (attempt {attempt}/{max_attempts}): {e}")
+
+                if attempt == max_attempts:
+                    raise
+
+                time.sleep(2 ** attempt)
+
+        # Add the listings on this page to the index
         if hasattr(response.reply, 'ItemArray') and hasattr(response.reply.ItemArray, 'Item'):
-            for item in response.reply.ItemArray.Item:
-                if hasattr(item, 'SKU') and item.SKU == isbn:
-                    return item.ItemID
+            items = response.reply.ItemArray.Item
+            if not isinstance(items, list):
+                items = [items]
 
-        # If we get here, no item was found with this ISBN as SKU
-        logger.warning(f"No eBay listing found for ISBN: {isbn}")
-        return None
+            for item in items:
+                if hasattr(item, 'SKU'):
+                    sku_index[item.SKU] = item.ItemID
 
-    except ConnectionError as e:
-        logger.error(f"eBay API error while searching for ISBN {isbn}: {e}")
-        return None
+        if getattr(response.reply, 'HasMoreItems', 'false') != 'true':
+            break
+
+        page_number += 1
+
+    logger.info(f"Indexed {len(sku_index)} eBay listings by SKU")
+    return sku_index
+
+# Maximum number of listings eBay accepts in one ReviseInventoryStatus call
+MAX_ITEMS_PER_REVISION = 4
+
+# Token bucket limiter to keep eBay API calls under the per-app call limit
+class RateLimiter:
+    """Allow up to `rate` calls per second, with bursts of up to `capacity` calls"""
 
-# Function to update an eBay item's price and quantity
-def update_ebay_item(api, item_id, new_price, new_quantity):
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait(self):
+        """Block until another call is allowed"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            time.sleep((1 - self.tokens) / self.rate)
+
+# Function to update the price and quantity of several eBay items
+def update_ebay_items(api, items):
     """
-    Update an eBay item's price and quantity
-    Returns True if successful, False otherwise
+    Update price and quantity of up to 4 eBay items in one ReviseInventoryStatus call
+    Takes a list of (item_id, new_price, new_quantity) tuples
+    Returns the set of item IDs that were updated successfully
     """
+    item_ids = [str(item_id) for item_id, _, _ in items]
+
     try:
-        # Prepare the request to update the item
+        # Prepare the request to update the items
         request = {
-            'Item': {
-                'ItemID': item_id,
-                'StartPrice': new_price,
-                'Quantity': new_quantity
-            }
+            'InventoryStatus': [
+                {
+                    'ItemID': item_id,
+                    'StartPrice': new_price,
+                    'Quantity': new_quantity
+                }
+                for item_id, new_price, new_quantity in items
+            ]
         }
 
-        # Execute the ReviseItem call
-        response = api.execute('ReviseItem', request)
-
-        # Check if the revision was successful
-        if response.reply.Ack == 'Success' or response.reply.Ack == 'Warning':
-            logger.info(f"Successfully updated eBay item {item_id}: Price={new_price}, Quantity={new_quantity}")
-            return True
-        else:
-            logger.error(f"Failed to update eBay item {item_id}: {response.reply.Errors}")
-            return False
+        # Execute the ReviseInventoryStatus call
+        response = api.execute('ReviseInventoryStatus', request)
 
     except ConnectionError as e:
-        logger.error(f"eBay API error while updating item {item_id}: {e}")
-        return False
+        logger.error(f"eBay API error while updating items {item_ids}: {e}")
+
+        # A failed call still reports the items that were revised
+        response = getattr(e, 'response', None)
+        if response is None:
+            return set()
+
+    # Collect the items eBay reports as revised
+    statuses = getattr(response.reply, 'InventoryStatus', [])
+    if not isinstance(statuses, list):
+        statuses = [statuses]
+
+    updated = {str(status.ItemID) for status in statuses}
+
+    if hasattr(response.reply, 'Errors'):
+        logger.error(f"Errors while updating eBay items {item_ids}: {response.reply.Errors}")
+
+    return updated
 
 # Function to get modified records from Supabase temporary table
 def get_modified_records(supabase, temp_table_name):
@@ -144,20 +229,47 @@ def get_modified_records(supabase, temp_table_name):
         return []
 
 # Function to track eBay update results
-def track_update_results(supabase, temp_table_name, isbn, success, details=None):
+def track_update_results(results, isbn, success, update_time, details=None):
     """
-    Update the temporary table with the eBay update status
+    Record the eBay update status of an ISBN, to be saved with save_update_results
     """
-    try:
-        # Update the record with eBay update status
-        supabase.table(temp_table_name).update({
-            'ebay_updated': success,
-            'ebay_update_time': datetime.now().isoformat(),
-            'ebay_update_details': details
-        }).eq('isbn', isbn).execute()
+    results.append({
+        'isbn': isbn,
+        'ebay_updated': success,
+        'ebay_update_time': update_time,
+        'ebay_update_details': details
+    })
+
+# Function to save eBay update results
+def save_update_results(supabase, temp_table_name, results):
+    """
+    Update the temporary table with the eBay update status of all processed records
+    """
+    # Update records in batches to avoid one request per record
+    batch_size = 500
 
-    except Exception as e:
-        logger.error(f"Error updating eBay status in Supabase for ISBN {isbn}: {e}")
+    for i in range(0, len(results), batch_size):
+        batch = results[i:i+batch_size]
+
+        try:
+            supabase.table(temp_table_name).upsert(batch, on_conflict='isbn').execute()
+            logger.info(f"Saved eBay update status for {len(batch)} records")
+
+        except Exception as e:
+            # Tables created before isbn became the primary key cannot be upserted on isbn
+            if getattr(e, 'code', None) != '42P10':
+                logger.error(f"Error updating eBay status in Supabase for {len(batch)} records: {e}")
+                continue
+
+            logger.info(f"{temp_table_name} has no unique key on isbn, updating records one at a time")
+            for result in batch:
+                try:
+                    supabase.table(temp_table_name).update({
+                        key: value for key, value in result.items() if key != 'isbn'
+                    }).eq('isbn', result['isbn']).execute()
+
+                except Exception as e:
+                    logger.error(f"Error updating eBay status in Supabase for ISBN {result['isbn']}: {e}")
 
 # Main function to process eBay updates
 def update_ebay_inventory():
@@ -190,6 +302,21 @@ def update_ebay_inventory():
         success_count = 0
         failure_count = 0
 
+        # Limit eBay API calls per second
+        rate_limiter = RateLimiter(float(os.getenv("EBAY_CALLS_PER_SECOND", 1)))
+
+        # Look up all eBay listings once
+        sku_index = build_sku_index(ebay_api, rate_limiter)
+
+        # Items found on eBay, waiting to be updated in batches
+        pending_items = []
+
+        # eBay update status of each record, saved to Supabase at the end
+        results = []
+
+        # Records checked against the SKU index share one timestamp
+        lookup_time = datetime.now().isoformat()
+
         for record in modified_records:
             isbn = record['isbn']
             new_stock = record['new_stock']
@@ -198,25 +325,39 @@ def update_ebay_inventory():
             logger.info(f"Processing ISBN: {isbn}, New Stock: {new_stock}, New RRP: {new_rrp}")
 
             # Get eBay item ID for this ISBN
-            item_id = get_ebay_item_id(ebay_api, isbn)
+            item_id = sku_index.get(isbn)
 
             if not item_id:
+                logger.warning(f"No eBay listing found for ISBN: {isbn}")
                 failure_count += 1
-                track_update_results(supabase, temp_table_name, isbn, False, "Item not found on eBay")
+                track_update_results(results, isbn, False, lookup_time, "Item not found on eBay")
                 continue
 
-            # Update the eBay item
-            success = update_ebay_item(ebay_api, item_id, new_rrp, new_stock)
+            pending_items.append((isbn, item_id, new_rrp, new_stock))
 
-            if success:
-                success_count += 1
-                track_update_results(supabase, temp_table_name, isbn, True, f"Updated on eBay: Item ID {item_id}")
-            else:
-                failure_count += 1
-                track_update_results(supabase, temp_table_name, isbn, False, f"Failed to update on eBay: Item ID {item_id}")
+        # Update the eBay items, several per API call
+        for i in range(0, len(pending_items), MAX_ITEMS_PER_REVISION):
+            batch = pending_items[i:i+MAX_ITEMS_PER_REVISION]
+
+            rate_limiter.wait()
+            items = [(item_id, new_rrp, new_stock) for _, item_id, new_rrp, new_stock in batch]
+            updated = update_ebay_items(ebay_api, items)
+
+            # Records revised in the same API call share one timestamp
+            update_time = datetime.now().isoformat()
+
+            for isbn, item_id, new_rrp, new_stock in batch:
+                if str(item_id) in updated:
+                    success_count += 1
+                    logger.info(f"Successfully updated eBay item {item_id}: Price={new_rrp}, Quantity={new_stock}")
+                    track_update_results(results, isbn, True, update_time, f"Updated on eBay: Item ID {item_id}")
+                else:
+                    failure_count += 1
+                    logger.error(f"Failed to update eBay item {item_id}")
+                    track_update_results(results, isbn, False, update_time, f"Failed to update on eBay: Item ID {item_id}")
 
-            # Sleep briefly to avoid eBay API rate limits
-            time.sleep(1)
+        # Save eBay update status to the temporary table
+        save_update_results(supabase, temp_table_name, results)
 
         # Log summary
         logger.info(f"eBay inventory update completed!")
@@ -261,7 +402,7 @@ TEMP_TABLE_NAME=your_temp_table_name
 
 if __name__ == "__main__":
     # For Colab, create an env file template
-    if 'google.colab' in str(get_ipython()):
+    if 'google.colab' in sys.modules:
         setup_env_file()
 
     # Run the main function
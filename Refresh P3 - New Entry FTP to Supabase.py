@@ -1,17 +1,21 @@
-# Install required packages
-!pip install supabase-py python-dotenv ftplib pandas
+# Install required packages, skipping any that are already present
+import importlib.util
+import subprocess
+import sys
+
+for module, package in [('supabase', 'supabase'), ('dotenv', 'python-dotenv'), ('h2', 'httpx[http2]')]:
+    if importlib.util.find_spec(module) is None:
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet', package])
 
 import os
 import io
 import csv
-import glob
-import pandas as pd
-import ftplib
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 from datetime import datetime
 import logging
-import tempfile
+from ftp_utils import connect_to_ftp, get_csv_files_from_ftp, download_csvs, close_ftp
 
 # Load environment variables
 load_dotenv()
@@ -39,109 +43,76 @@ def setup_supabase():
 
     # Initialize Supabase client
     logger.info("Setting up Supabase connection")
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    return supabase
 
-# Function to connect to FTP server using environment variables
-def connect_to_ftp():
-    """Connect to FTP server using environment variables"""
-    # Get FTP credentials from environment variables
-    FTP_HOST = os.getenv("FTP_HOST")
-    FTP_USER = os.getenv("FTP_USER")
-    FTP_PASS = os.getenv("FTP_PASS")
-    FTP_PATH = os.getenv("FTP_PATH", "/")  # Default to root if not specified
-
-    if not all([FTP_HOST, FTP_USER, FTP_PASS]):
-        raise ValueError("Missing FTP credentials. Please set FTP_HOST, FTP_USER, and FTP_PASS environment variables.")
+    # Share one pooled HTTP/2 client with keep-alive connections across requests;
+    # reads keep supabase-py's 120 s default, since large SQL calls can run long
+    http_client = httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=20),
+        timeout=httpx.Timeout(30, read=120)
+    )
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
+    return supabase
 
+# Function to parse a downloaded CSV file
+def parse_csv(content, filename):
+    """Parse the content of a downloaded CSV file"""
     try:
-        # Connect to FTP server
-        logger.info(f"Connecting to FTP server: {FTP_HOST}")
-        ftp = ftplib.FTP(FTP_HOST)
-        ftp.login(FTP_USER, FTP_PASS)
+        # Read the CSV file
+        reader = csv.DictReader(io.TextIOWrapper(io.BytesIO(content), encoding='utf-8-sig'))
+        rows = list(reader)
 
-        # Change to specified directory if provided
-        if FTP_PATH != "/":
-            ftp.cwd(FTP_PATH)
-            logger.info(f"Changed to directory: {FTP_PATH}")
+        logger.info(f"Successfully parsed {filename} with {len(rows)} rows")
+        return rows
 
-        return ftp
     except Exception as e:
-        logger.error(f"Failed to connect to FTP server: {str(e)}")
-        raise
-
-# Function to get all CSV files from FTP server
-def get_csv_files_from_ftp(ftp):
-    """Get all CSV files from FTP server"""
-    # Get all file names in the current directory
-    file_list = []
-
-    try:
-        # List all files in the current directory
-        ftp.retrlines('LIST', lambda x: file_list.append(x.split()[-1]))
-
-        # Filter for .text or .csv files
-        csv_files = [f for f in file_list if f.endswith('.text') or f.endswith('.csv')]
-
-        if not csv_files:
-            logger.warning("No CSV files found on FTP server")
-            return []
+        logger.error(f"Error parsing {filename}: {str(e)}")
+        return []
 
-        logger.info(f"Found {len(csv_files)} CSV files on FTP server")
-        return csv_files
+# Function to get all ISBNs from a Supabase table
+def get_table_isbns(supabase, table_name):
+    """Get all ISBNs from a Supabase table"""
+    isbns = set()
 
-    except Exception as e:
-        logger.error(f"Error listing files on FTP server: {str(e)}")
-        return []
+    # Fetch in pages since Supabase caps the number of rows per request
+    page_size = 1000
+    offset = 0
 
-# Function to download and parse a CSV file from FTP
-def download_and_parse_csv(ftp, filename):
-    """Download and parse a CSV file from FTP server"""
-    try:
-        # Create a temporary file to store CSV content
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
-            # Download the file
-            logger.info(f"Downloading {filename} from FTP server")
-            ftp.retrbinary(f"RETR {filename}", temp_file.write)
-            temp_filename = temp_file.name
+    while True:
+        response = supabase.table(table_name) \
+            .select("isbn") \
+            .order("isbn") \
+            .range(offset, offset + page_size - 1) \
+            .execute()
 
-        # Read the CSV file
-        with open(temp_filename, 'r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            rows = list(reader)
+        isbns |= {item['isbn'] for item in response.data}
 
-        # Clean up temporary file
-        os.unlink(temp_filename)
+        if len(response.data) < page_size:
+            break
 
-        logger.info(f"Successfully parsed {filename} with {len(rows)} rows")
-        return rows
+        offset += page_size
 
-    except Exception as e:
-        logger.error(f"Error downloading or parsing {filename}: {str(e)}")
-        return []
+    return isbns
 
 # Function to get existing ISBNs from Supabase tables
 def get_existing_isbns(supabase):
-    """Get existing ISBNs from Inventory and Below Stock tables"""
-    existing_isbns = set()
-
+    """
+    Get existing ISBNs from Inventory and Below Stock tables
+    Returns None if they could not all be read, so a partial set is never used
+    """
     try:
-        # Query Inventory table
-        inventory_response = supabase.table("Inventory").select("isbn").execute()
-        for item in inventory_response.data:
-            existing_isbns.add(item['isbn'])
-
-        # Query Below Stock table
-        below_stock_response = supabase.table("Below Stock").select("isbn").execute()
-        for item in below_stock_response.data:
-            existing_isbns.add(item['isbn'])
+        # Query Inventory and Below Stock tables
+        existing_isbns = frozenset(
+            get_table_isbns(supabase, "Inventory") | get_table_isbns(supabase, "Below Stock")
+        )
 
         logger.info(f"Found {len(existing_isbns)} existing ISBNs in Supabase tables")
         return existing_isbns
 
     except Exception as e:
         logger.error(f"Error retrieving existing ISBNs from Supabase: {str(e)}")
-        return set()
+        return None
 
 # Function to insert new ISBNs into the "New ISBN" table
 def insert_new_isbns(supabase, new_isbn_records):
@@ -176,11 +147,17 @@ def discover_new_isbns():
     try:
         # Setup connections
         supabase = setup_supabase()
-        ftp = connect_to_ftp()
 
         # Get existing ISBNs from Supabase
         existing_isbns = get_existing_isbns(supabase)
 
+        # Without them every ISBN in the CSV files would look new
+        if existing_isbns is None:
+            logger.error("Could not load existing ISBNs. Exiting without inserting anything.")
+            return
+
+        ftp = connect_to_ftp()
+
         # Get all CSV files from FTP server
         csv_files = get_csv_files_from_ftp(ftp)
 
@@ -190,11 +167,16 @@ def discover_new_isbns():
 
         # Process each CSV file
         new_isbn_records = []
+        seen_isbns = set()
         min_stock_threshold = 4  # Stock must be 4 or more
 
-        for filename in csv_files:
-            # Download and parse CSV file
-            rows = download_and_parse_csv(ftp, filename)
+        # All ISBNs discovered in this run share one timestamp
+        discovered_at = datetime.now().isoformat()
+
+        # Download the CSV files while they are processed, so only a few are in memory at once
+        for filename, content in download_csvs(ftp, csv_files):
+            # Parse CSV file
+            rows = parse_csv(content, filename)
 
             # Process each row
             for row in rows:
@@ -204,8 +186,8 @@ def discover_new_isbns():
 
                 isbn = row['isbn'].strip()
 
-                # Skip if ISBN is already in Supabase
-                if isbn in existing_isbns:
+                # Skip if ISBN is already in Supabase or was found earlier in this run
+                if isbn in existing_isbns or isbn in seen_isbns:
                     continue
 
                 # Check stock level
@@ -226,21 +208,21 @@ def discover_new_isbns():
                     'author': row.get('author', ''),
                     'publisher': row.get('publisher', ''),
                     'rrp': float(row.get('rrp', 0)) if row.get('rrp') else None,
-                    'discovered_at': datetime.now().isoformat(),
+                    'discovered_at': discovered_at,
                     'source_file': filename
                 }
 
                 # Add to new ISBNs list
                 new_isbn_records.append(record)
 
-                # Add to existing ISBNs to avoid duplicates
-                existing_isbns.add(isbn)
+                # Remember ISBN to avoid duplicates
+                seen_isbns.add(isbn)
 
         # Insert new ISBNs into Supabase
         total_inserted = insert_new_isbns(supabase, new_isbn_records)
 
-        # Close FTP connection
-        ftp.quit()
+        # Close FTP connection; the server may already have dropped it while idle
+        close_ftp(ftp)
 
         logger.info(f"New ISBN discovery completed! Found {len(new_isbn_records)} new ISBNs with stock >= {min_stock_threshold}")
 
@@ -278,7 +260,7 @@ FTP_PATH=your_ftp_directory_path
 
 if __name__ == "__main__":
     # For Colab, create an env file template
-    if 'google.colab' in str(get_ipython()):
+    if 'google.colab' in sys.modules:
         setup_env_file()
 
     # Run the main function
@@ -0,0 +1,303 @@
+# Shared FTP helpers for the Refresh scripts
+
+import os
+import io
+import re
+import time
+import tempfile
+import ftplib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+logger = logging.getLogger()
+
+# Block size for FTP downloads; larger than ftplib's 8 KB default for better throughput
+FTP_BLOCKSIZE = 65536
+
+# Directory where downloaded files are kept, so the scripts can reuse each other's downloads
+# of unchanged files even when they run in separate processes; set FTP_CACHE_DIR to "" to disable
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ftp_refresh_cache")
+
+# MLSD size and modify facts from the last listing, as {(host, path): {filename: (size, modify)}}
+_file_facts = {}
+
+# Parsed directory listings as {(host, path): (listing time, filenames)}.
+# Only filled when FTP_LISTING_CACHE_TTL is set, since a cached listing misses newly uploaded files
+_listing_cache = {}
+
+# Function to connect to FTP server using environment variables
+def connect_to_ftp():
+    """Connect to FTP server using environment variables"""
+    # Get FTP credentials from environment variables
+    FTP_HOST = os.getenv("FTP_HOST")
+    FTP_USER = os.getenv("FTP_USER")
+    FTP_PASS = os.getenv("FTP_PASS")
+    FTP_PATH = os.getenv("FTP_PATH", "/")  # Default to root if not specified
+
+    if not all([FTP_HOST, FTP_USER, FTP_PASS]):
+        raise ValueError("Missing FTP credentials. Please set FTP_HOST, FTP_USER, and FTP_PASS environment variables.")
+
+    try:
+        # Connect to FTP server
+        logger.info(f"Connecting to FTP server: {FTP_HOST}")
+        ftp = ftplib.FTP(FTP_HOST)
+        ftp.login(FTP_USER, FTP_PASS)
+
+        # Change to specified directory if provided
+        if FTP_PATH != "/":
+            ftp.cwd(FTP_PATH)
+            logger.info(f"Changed to directory: {FTP_PATH}")
+
+        return ftp
+    except Exception as e:
+        logger.error(f"Failed to connect to FTP server: {str(e)}")
+        raise
+
+# Function to get all CSV files from FTP server
+def get_csv_files_from_ftp(ftp):
+    """Get all CSV files from FTP server, reusing a recent listing of the same directory"""
+    try:
+        # Listings are only reused for FTP_LISTING_CACHE_TTL seconds when it is set
+        cache_ttl = int(os.getenv("FTP_LISTING_CACHE_TTL", 0))
+        cache_key = (ftp.host, ftp.pwd())
+        cached = _listing_cache.get(cache_key)
+
+        if cache_ttl > 0 and cached and time.time() - cached[0] <= cache_ttl:
+            logger.info(f"Using cached listing of {len(cached[1])} CSV files on FTP server")
+            return list(cached[1])
+
+        try:
+            # List all files in the current directory with structured MLSD entries
+            entries = [(name, facts) for name, facts in ftp.mlsd() if facts.get('type') == 'file']
+            file_list = [name for name, facts in entries]
+
+            # Keep the size and modification time so cached downloads can be checked without another listing
+            _file_facts[cache_key] = {name: (facts.get('size'), facts.get('modify')) for name, facts in entries}
+        except ftplib.error_perm as e:
+            # Fall back to LIST on servers that do not support MLSD
+            logger.info(f"MLSD not supported, falling back to LIST: {str(e)}")
+            file_list = []
+            ftp.retrlines('LIST', lambda x: file_list.append(x.split()[-1]))
+            _file_facts[cache_key] = {}
+
+        # Filter for .text or .csv files
+        csv_files = [f for f in file_list if f.endswith('.text') or f.endswith('.csv')]
+
+        if not csv_files:
+            logger.warning("No CSV files found on FTP server")
+            return []
+
+        if cache_ttl > 0:
+            _listing_cache[cache_key] = (time.time(), tuple(csv_files))
+
+        logger.info(f"Found {len(csv_files)} CSV files on FTP server")
+        return csv_files
+
+    except Exception as e:
+        logger.error(f"Error listing files on FTP server: {str(e)}")
+        return []
+
+# Function to download a CSV file from FTP
+def download_csv(ftp, filename):
+    """
+    Download a CSV file from FTP server into memory
+    Returns the file content, or None if the download failed
+    """
+    try:
+        # Download the file straight into memory
+        logger.info(f"Downloading {filename} from FTP server")
+        buffer = io.BytesIO()
+        ftp.retrbinary(f"RETR {filename}", buffer.write, blocksize=FTP_BLOCKSIZE)
+        return buffer.getvalue()
+
+    except Exception as e:
+        logger.error(f"Error downloading {filename}: {str(e)}")
+        return None
+
+# Function to close an FTP connection, even if it is already broken
+def close_ftp(ftp):
+    """Close an FTP connection, falling back to dropping the socket if QUIT fails"""
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+# Function to make sure an idle FTP connection is still open
+def keep_alive(ftp):
+    """Check an FTP connection with NOOP and log in again if the server has dropped it"""
+    try:
+        ftp.voidcmd('NOOP')
+    except ftplib.all_errors:
+        logger.info("FTP connection was closed by the server, reconnecting")
+        ftp.close()
+
+        try:
+            ftp.connect(ftp.host, ftp.port)
+            ftp.login(os.getenv("FTP_USER"), os.getenv("FTP_PASS"))
+
+            FTP_PATH = os.getenv("FTP_PATH", "/")
+            if FTP_PATH != "/":
+                ftp.cwd(FTP_PATH)
+        except ftplib.all_errors as e:
+            logger.error(f"Failed to reconnect to FTP server: {str(e)}")
+
+# Function to download CSV files in order on several FTP connections
+def iter_downloads(ftp, filenames):
+    """
+    Download files on up to FTP_MAX_CONNECTIONS connections, counting the open one
+    Yields (filename, bytes or None) in order, holding only a few downloads in memory
+    """
+    # A single FTP connection transfers one file at a time, so extra connections are
+    # opened for parallel downloads; the already-open connection counts against the limit
+    max_connections = int(os.getenv("FTP_MAX_CONNECTIONS", 4))
+    worker_count = min(max_connections - 1, len(filenames))
+
+    if worker_count <= 0:
+        for filename in filenames:
+            yield filename, download_csv(ftp, filename)
+        return
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    # Set once the server refuses another login, so no more connections are attempted
+    connect_failed = threading.Event()
+
+    def download(filename):
+        if getattr(local, 'ftp', None) is None:
+            if connect_failed.is_set():
+                return None
+
+            try:
+                local.ftp = connect_to_ftp()
+            except ftplib.all_errors:
+                # e.g. "421 too many connections"; the file is fetched on the open connection instead
+                connect_failed.set()
+                logger.warning("Could not open another FTP connection, downloading on fewer connections")
+                return None
+
+            with lock:
+                connections.append(local.ftp)
+
+        content = download_csv(local.ftp, filename)
+
+        if content is None:
+            # The connection may be unusable after a failed transfer, so reconnect for the next file
+            with lock:
+                connections.remove(local.ftp)
+            close_ftp(local.ftp)
+            local.ftp = None
+
+        return content
+
+    try:
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            # Keep only worker_count downloads in flight so finished files do not pile up in memory
+            remaining = iter(filenames)
+            pending = deque((f, executor.submit(download, f)) for f in islice(remaining, worker_count))
+
+            while pending:
+                filename, future = pending.popleft()
+                content = future.result()
+
+                for next_filename in islice(remaining, 1):
+                    pending.append((next_filename, executor.submit(download, next_filename)))
+
+                if content is None:
+                    # Retry files the workers could not fetch on the already-open connection,
+                    # which may have been dropped by the server while it sat idle
+                    keep_alive(ftp)
+                    content = download_csv(ftp, filename)
+
+                yield filename, content
+    finally:
+        # Close the worker connections
+        for worker_ftp in connections:
+            close_ftp(worker_ftp)
+
+# Function to get the local cache path of a file on FTP server
+def cache_path(cache_dir, filename, facts):
+    """
+    Get the path a downloaded file is cached at, named after its size and modification time
+    Returns None if the file cannot be cached because its facts are unknown
+    """
+    size, modify = facts.get(filename, (None, None))
+
+    if not cache_dir or size is None or modify is None:
+        return None
+
+    return os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', f"{modify}_{size}_{filename}"))
+
+# Function to download CSV files from FTP
+def download_csvs(ftp, csv_files):
+    """
+    Download CSV files in parallel, yielding (filename, bytes) in the order of csv_files
+    Files that have not changed since an earlier run are read from the local cache instead
+    Files that could not be downloaded are skipped
+    """
+    path = ftp.pwd()
+    facts = _file_facts.get((ftp.host, path), {})
+
+    # Keep each server directory's files apart
+    cache_dir = os.getenv("FTP_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if cache_dir:
+        cache_dir = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', f"{ftp.host}{path}"))
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # A cached copy is only used if the file's size and modification time on the server are unchanged
+    paths = {filename: cache_path(cache_dir, filename, facts) for filename in csv_files}
+    cached = {filename for filename, file_path in paths.items() if file_path and os.path.exists(file_path)}
+
+    if cached:
+        logger.info(f"Reusing {len(cached)} unchanged CSV files downloaded earlier")
+
+    if cache_dir:
+        # Remove copies of files that have since changed or been deleted from the server
+        current = {os.path.basename(file_path) for file_path in paths.values() if file_path}
+        for name in os.listdir(cache_dir):
+            if name not in current and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+
+    downloads = iter_downloads(ftp, [f for f in csv_files if f not in cached])
+
+    try:
+        for filename in csv_files:
+            file_path = paths[filename]
+
+            if filename in cached:
+                try:
+                    with open(file_path, 'rb') as f:
+                        content = f.read()
+                except OSError:
+                    # Removed by another run in the meantime, so download it after all
+                    keep_alive(ftp)
+                    content = download_csv(ftp, filename)
+                else:
+                    yield filename, content
+                    continue
+            else:
+                _, content = next(downloads)
+
+            if content is None:
+                continue
+
+            if file_path:
+                # Write to a temporary file first, so other runs never read a partial copy
+                tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(content)
+                    os.replace(tmp_path, file_path)
+                except OSError as e:
+                    logger.warning(f"Could not cache {filename}: {str(e)}")
+
+            yield filename, content
+    finally:
+        downloads.close()